@@ -1,40 +1,60 @@
+import asyncio
+import hashlib
 import json
 import os
+import shutil
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
+import numpy as np
+import anyio
+
+# Let the CUDA caching allocator grow segments instead of fragmenting; must be set before torch touches CUDA.
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
 import torch
+import torch.nn.functional as F
 import whisperx
+from whisperx import asr as whisperx_asr
+from whisperx.audio import HOP_LENGTH, N_FFT, N_SAMPLES, SAMPLE_RATE, mel_filters
+from whisperx.utils import LANGUAGES
+from whisperx.vads import Pyannote, Vad
+from faster_whisper.audio import decode_audio
+from faster_whisper.tokenizer import Tokenizer
+import av
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.formparsers import MultiPartParser
 import tempfile
-import datetime
-from pydantic import BaseModel
-from pyannote.core import Segment as PyannoteSegment
+from pydantic import BaseModel, ConfigDict, StrictFloat, with_config
 from typing import Any, List, Dict, Optional
+from typing_extensions import NotRequired, TypedDict
 
 load_dotenv()
 
 # --- Pydantic Models for Data Validation (New) ---
-class Word(BaseModel):
-    start: Optional[float] = None
-    end: Optional[float] = None
-    word: str
-    speaker: Optional[str] = None
-    score: Optional[Any] = None
-
-class Segment(BaseModel):
-    start: float
-    end: float
+# A TypedDict validates to a plain dict, so segments come out in the shape /transcribe
+# returns with no per-segment model to dump; other keys (words, scores) pass through as-is.
+@with_config(ConfigDict(extra='allow'))
+class Segment(TypedDict):
+    # Strict so JSON true/false aren't accepted as times; ints still validate as floats
+    start: StrictFloat
+    end: StrictFloat
     text: str
-    speaker: Optional[str] = None
-    words: Optional[List[Word]] = None
+    speaker: NotRequired[Optional[str]]
 
 class RenameSpeakersRequest(BaseModel):
+  # Segments are validated once by pydantic-core and then rewritten in place
   segments: List[Segment]
   speaker_map: Dict[str, str]
 
 
 # --- Application Setup ---
-app = FastAPI()
+# Segment payloads carry thousands of word timings; orjson serializes floats far faster than json.
+# The segment endpoints also return ORJSONResponse themselves: a plain dict would first be
+# walked by FastAPI's pure-Python jsonable_encoder before orjson ever saw it.
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # --- CORS Middleware ---
 origins = [
@@ -54,52 +74,502 @@ app.add_middleware(
 # --- Configuration ---
 HF_TOKEN = os.getenv("HF_TOKEN")
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-COMPUTE_TYPE = "float16" if torch.cuda.is_available() else "int8"
+# CTranslate2 int8 weights with float16 activations on GPU; plain int8 on CPU.
+COMPUTE_TYPE = "int8_float16" if torch.cuda.is_available() else "int8"
 MODEL_SIZE = "large-v3"
+# Number of VAD chunks decoded together in one encoder/decoder batch.
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "16"))
+# Maximum length in seconds of a merged VAD chunk (Whisper's input window).
+VAD_CHUNK_SIZE = 30
+# Greedy decoding: beam search multiplies decoder work for little accuracy gain on subtitles.
+ASR_OPTIONS = {"beam_size": 1}
+# Alignment models loaded, compiled and warmed up at startup; they stay resident.
+PRELOAD_ALIGN_LANGS = [lang.strip() for lang in os.getenv("PRELOAD_ALIGN_LANGS", "en,es,fr").split(",") if lang.strip()]
+# How many other languages' alignment models (loaded on first use, uncompiled) stay resident.
+ALIGN_CACHE_SIZE = int(os.getenv("ALIGN_CACHE_SIZE", "2"))
+
+# Uploads are hashed in chunks of this size instead of being read whole.
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Uploads up to this size stay in memory; Starlette spools larger ones to a temp file.
+SPOOL_MAX_SIZE = 64 << 20
+# Starlette rolls multipart uploads over to disk past 1 MiB by default; keep them in memory up to SPOOL_MAX_SIZE.
+MultiPartParser.spool_max_size = SPOOL_MAX_SIZE
+# Memory budget in MB for decoded uploads kept around for follow-up requests on the same file.
+AUDIO_CACHE_MB = int(os.getenv("AUDIO_CACHE_MB", "512"))
 
 # --- Model Loading ---
 models = {}
+audio_cache = OrderedDict()
+# Decodes run on worker threads outside gpu_semaphore, so the cache needs its own lock.
+audio_cache_lock = threading.Lock()
+# Alignment models for languages outside PRELOAD_ALIGN_LANGS, least recently used first.
+align_cache = OrderedDict()
+# The models are not safe for concurrent forward passes, so one inference job runs at a time.
+gpu_semaphore = asyncio.Semaphore(1)
+# Hann window and mel filterbanks, registered on DEVICE once at startup.
+mel_tensors = {}
+# Whisper tokenizers per language, shared by every batch decoded in that language.
+tokenizers = {}
+# Pending (chunks, language_code, future) jobs for the cross-request batcher.
+transcription_queue = asyncio.Queue()
 
 @app.on_event("startup")
 def load_models():
     """Load all necessary models into memory when the server starts."""
     print(f"Loading models to device: {DEVICE}")
-    models['whisper'] = whisperx.load_model(MODEL_SIZE, DEVICE, compute_type=COMPUTE_TYPE)
-    models['whisper_tiny'] = whisperx.load_model("tiny", DEVICE, compute_type=COMPUTE_TYPE)
+    if DEVICE == "cuda":
+        # TF32 tensor cores for the fp32 PyTorch models (alignment, diarization, VAD)
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    models['whisper'] = whisperx.load_model(MODEL_SIZE, DEVICE, compute_type=COMPUTE_TYPE, asr_options=ASR_OPTIONS)
+
+    if DEVICE == "cuda":
+        install_gpu_features()
+
+    models['align'] = {}
+    for language_code in PRELOAD_ALIGN_LANGS:
+        print(f"Preparing alignment model for '{language_code}'...")
+        models['align'][language_code] = load_optimized_align_model(language_code, compile_model=True)
     
     if not HF_TOKEN or HF_TOKEN == "YOUR_HUGGING_FACE_TOKEN":
         print("Warning: Hugging Face token not set. Speaker diarization will fail.")
         models['diarize'] = None
     else:
         models['diarize'] = whisperx.diarize.DiarizationPipeline(use_auth_token=HF_TOKEN, device=DEVICE) # type: ignore
+
+    if DEVICE == "cuda":
+        warm_up_models()
     
     print("Models loaded successfully.")
 
+def warm_up_models():
+    """
+    Runs one request's worth of GPU work on 30s of synthetic voiced audio, so
+    CUDA kernel loading and allocator growth happen before the first request:
+    VAD and language detection, one full BATCH_SIZE decode through the batcher's
+    decode_jobs path, and diarization.
+    """
+    print("Warming up models...")
+    # Harmonics of a 150 Hz voice with a 4 Hz syllable envelope: unlike silence, this
+    # gets past the VAD/segmentation early exits. Diarization still only runs its
+    # embedding model if pyannote's segmentation labels the signal as speech.
+    t = np.arange(N_SAMPLES, dtype=np.float32) / SAMPLE_RATE
+    voice = sum(np.sin(2 * np.pi * 150 * harmonic * t) / harmonic for harmonic in range(1, 6))
+    envelope = 0.5 * (1 - np.cos(2 * np.pi * 4 * t))
+    signal = (0.1 * voice * envelope).astype(np.float32)
+
+    prepare_transcription(signal)
+    decode_jobs([([signal] * BATCH_SIZE, "en", None)])
+    if diarize_model := models.get('diarize'):
+        with torch.inference_mode():
+            diarize_model(signal)
+
+@app.on_event("startup")
+async def start_batcher():
+    """Starts the background task that batches Whisper decoding across requests."""
+    app.state.batcher = asyncio.create_task(batch_worker())
+
+# --- GPU Feature Extraction ---
+def gpu_log_mel_spectrogram(audio, n_mels: int = 80, padding: int = 0):
+    """
+    Replacement for whisperx.asr's log_mel_spectrogram (called as
+    (audio, n_mels=..., padding=...)) that runs the
+    STFT and mel projection on the GPU with the pre-registered window and
+    filterbank. Accepts a single waveform or a (batch, samples) tensor and
+    leaves the features on the GPU so CTranslate2 reads them without a host copy.
+    """
+    if isinstance(audio, str):
+        audio = whisperx.load_audio(audio)
+    if not torch.is_tensor(audio):
+        audio = torch.from_numpy(audio)
+
+    audio = audio.to(DEVICE, non_blocking=True)
+    if padding > 0:
+        audio = F.pad(audio, (0, padding))
+
+    stft = torch.stft(audio, N_FFT, HOP_LENGTH, window=mel_tensors['window'], return_complex=True)
+    magnitudes = stft[..., :-1].abs() ** 2
+    mel_spec = mel_tensors[n_mels] @ magnitudes
+
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    # Normalise per waveform so a batched call matches one call per chunk
+    log_spec = torch.maximum(log_spec, log_spec.amax(dim=(-2, -1), keepdim=True) - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+def install_gpu_features():
+    """Routes WhisperX's feature extraction through gpu_log_mel_spectrogram."""
+    mel_tensors['window'] = torch.hann_window(N_FFT, device=DEVICE)
+    for n_mels in (80, 128):
+        mel_tensors[n_mels] = mel_filters(DEVICE, n_mels)
+
+    # WhisperModel.encode only unsqueezes numpy arrays, so give single tensors a batch dim.
+    encode = whisperx_asr.WhisperModel.encode
+    def encode_features(self, features):
+        if torch.is_tensor(features) and features.dim() == 2:
+            features = features.unsqueeze(0)
+        return encode(self, features)
+
+    whisperx_asr.WhisperModel.encode = encode_features
+    whisperx_asr.log_mel_spectrogram = gpu_log_mel_spectrogram
+
+# --- Alignment Models ---
+def load_optimized_align_model(language_code: str, compile_model: bool = False):
+    """
+    Loads the wav2vec2 alignment model for a language and optimizes it for the
+    device. On CUDA, `compile_model` compiles it and runs a dummy 30s clip through
+    it so the compile cost is paid up front; on CPU its Linear layers are
+    quantized to int8.
+    """
+    align_model, metadata = whisperx.load_align_model(language_code=language_code, device=DEVICE)
+    if DEVICE == "cuda":
+        if compile_model:
+            # Segment lengths vary per request, so compile for dynamic shapes instead of
+            # capturing CUDA graphs that would be re-recorded for every new length.
+            align_model = torch.compile(align_model, dynamic=True, fullgraph=False)
+            with torch.inference_mode():
+                align_model(torch.zeros(1, SAMPLE_RATE * 30, device=DEVICE))
+    else:
+        # The transformer trunk is memory-bound on CPU; int8 weights halve the bytes read,
+        # matching the int8 compute type Whisper already uses there.
+        align_model = torch.ao.quantization.quantize_dynamic(align_model, {torch.nn.Linear}, dtype=torch.qint8)
+    return align_model, metadata
+
+def get_align_model(language_code: str):
+    """
+    Returns the alignment model for a language. Preloaded languages are always
+    resident; others are loaded uncompiled on first use, since compiling would
+    stall every queued request, and only the ALIGN_CACHE_SIZE most recently used
+    of them are kept.
+    """
+    if language_code in models['align']:
+        return models['align'][language_code]
+
+    if language_code in align_cache:
+        align_cache.move_to_end(language_code)
+        return align_cache[language_code]
+
+    print(f"Loading alignment model for '{language_code}'...")
+    align_cache[language_code] = load_optimized_align_model(language_code)
+    if len(align_cache) > ALIGN_CACHE_SIZE:
+        align_cache.popitem(last=False)
+    return align_cache[language_code]
+
+def get_language_detector():
+    """
+    Returns the tiny Whisper model /resync uses to detect the language, loading
+    it on first use so deployments whose clients always send one never hold it.
+    """
+    if 'whisper_tiny' not in models:
+        print("Loading tiny Whisper model for language detection...")
+        models['whisper_tiny'] = whisperx.load_model("tiny", DEVICE, compute_type=COMPUTE_TYPE, asr_options=ASR_OPTIONS)
+    return models['whisper_tiny']
+
 # --- Helper Functions ---
+def hash_upload(upload) -> str:
+    """Hashes an upload's spooled file chunk by chunk, rewinds it and returns its SHA-1 digest."""
+    digest = hashlib.sha1()
+    upload.seek(0)
+    while chunk := upload.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+    upload.seek(0)
+    return digest.hexdigest()
+
+def decode_upload(upload):
+    """Decodes an upload's spooled file (UploadFile.file) to 16 kHz mono float32 PCM."""
+    try:
+        # PyAV decodes the spool in-process whether Starlette kept it in memory or rolled it
+        # to disk: no ffmpeg fork/exec or extra copy per request, and the input stays
+        # seekable, so MP4s with their index at the end work too.
+        upload.seek(0)
+        return decode_audio(upload, sampling_rate=SAMPLE_RATE)
+    except av.error.FFmpegError:
+        # Fall back to the ffmpeg CLI for anything PyAV's bundled codecs can't handle
+        with tempfile.NamedTemporaryFile(delete=True) as temp_file:
+            upload.seek(0)
+            shutil.copyfileobj(upload, temp_file, UPLOAD_CHUNK_SIZE)
+            temp_file.flush()
+            return whisperx.load_audio(temp_file.name)
+
+def load_audio_cached(upload):
+    """
+    Decodes an upload once and keeps the PCM array keyed by the upload's
+    SHA-1, so editing the same file again skips the decode. Hashing and decoding
+    block on CPU and disk, so callers run it on a worker thread before taking
+    gpu_semaphore.
+    """
+    digest = hash_upload(upload)
+    with audio_cache_lock:
+        if digest in audio_cache:
+            audio_cache.move_to_end(digest)
+            return audio_cache[digest]
+
+    # Decode without the lock so concurrent uploads decode in parallel
+    audio = decode_upload(upload)
+    budget = AUDIO_CACHE_MB << 20
+    if audio.nbytes <= budget:
+        with audio_cache_lock:
+            audio_cache[digest] = audio
+            # Evict least recently used decodes until the total PCM fits the budget
+            while sum(cached.nbytes for cached in audio_cache.values()) > budget:
+                audio_cache.popitem(last=False)
+    return audio
+
 def format_time(seconds):
-    delta = datetime.timedelta(seconds=seconds)
-    hours, remainder = divmod(delta.seconds, 3600)
-    minutes, seconds = divmod(remainder, 60)
-    milliseconds = delta.microseconds // 1000
+    # Round to whole microseconds first so values like 1.001 don't truncate to 1.000
+    milliseconds = round(seconds * 1_000_000) // 1000
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
     return f"{hours:02}:{minutes:02}:{seconds:02},{milliseconds:03}"
 
 def generate_srt(segments: List[Dict]) -> str:
     """Formats a list of segments into an SRT string."""
-    srt_content = ""
-    for i, segment in enumerate(segments):
+    # Collect one block per cue and join once; repeated += is quadratic in the worst case
+    parts = []
+    append = parts.append
+    for i, segment in enumerate(segments, 1):
         start_time = format_time(segment['start'])
         end_time = format_time(segment['end'])
         speaker = segment.get('speaker', 'SPEAKER_UNKNOWN')
         text = segment['text'].strip()
-        
+
         # Add speaker label to text if it exists
         line = f"[{speaker}]: {text}" if 'speaker' in segment else text
 
-        srt_content += f"{i + 1}\n"
-        srt_content += f"{start_time} --> {end_time}\n"
-        srt_content += f"{line}\n\n"
-        
-    return srt_content
+        append(f"{i}\n{start_time} --> {end_time}\n{line}\n\n")
+
+    return "".join(parts)
+
+# --- Cross-Request Batching ---
+def get_tokenizer(language_code: str):
+    """Returns the Whisper tokenizer for a language, building it on first use."""
+    if language_code not in tokenizers:
+        model = models['whisper'].model
+        tokenizers[language_code] = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=language_code)
+    return tokenizers[language_code]
+
+def extract_features(chunks: List[np.ndarray]):
+    """Log-mel features for a batch of VAD chunks, each padded to Whisper's 30s window."""
+    n_mels = models['whisper'].model.feat_kwargs.get("feature_size") or 80
+    if DEVICE == "cuda":
+        batch = torch.stack([F.pad(torch.from_numpy(chunk), (0, max(N_SAMPLES - chunk.shape[0], 0))) for chunk in chunks])
+        return gpu_log_mel_spectrogram(batch, n_mels)
+    return torch.stack([
+        whisperx_asr.log_mel_spectrogram(chunk, n_mels=n_mels, padding=max(N_SAMPLES - chunk.shape[0], 0))
+        for chunk in chunks
+    ])
+
+def decode_jobs(jobs) -> List[List[str]]:
+    """
+    Decodes the chunks of every queued job. Chunks of jobs sharing a language
+    are packed into common batches of up to BATCH_SIZE; returns the texts per job.
+    """
+    pipeline = models['whisper']
+    results = [[] for _ in jobs]
+
+    by_language = {}
+    for index, (chunks, language_code, _) in enumerate(jobs):
+        by_language.setdefault(language_code, []).extend((index, chunk) for chunk in chunks)
+
+    with torch.inference_mode():
+        for language_code, indexed_chunks in by_language.items():
+            tokenizer = get_tokenizer(language_code)
+            for start in range(0, len(indexed_chunks), BATCH_SIZE):
+                batch = indexed_chunks[start:start + BATCH_SIZE]
+                features = extract_features([chunk for _, chunk in batch])
+                texts = pipeline.model.generate_segment_batched(features, tokenizer, pipeline.options)
+                for (index, _), text in zip(batch, texts):
+                    results[index].append(text)
+
+    return results
+
+async def batch_worker():
+    """
+    Waits for a pending job, then for the GPU. Once it holds gpu_semaphore it
+    drains whatever else queued up meanwhile (up to BATCH_SIZE chunks), decodes
+    those jobs together and resolves each job's future. Batches form from
+    requests that arrived while the GPU was busy, with no fixed delay.
+    """
+    while True:
+        first_job = await transcription_queue.get()
+
+        async with gpu_semaphore:
+            jobs = [first_job]
+            pending_chunks = len(first_job[0])
+            while pending_chunks < BATCH_SIZE:
+                try:
+                    job = transcription_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                jobs.append(job)
+                pending_chunks += len(job[0])
+
+            try:
+                results = await anyio.to_thread.run_sync(decode_jobs, jobs)
+            except Exception as e:
+                for _, _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+        for (_, _, future), texts in zip(jobs, results):
+            if not future.done():
+                future.set_result(texts)
+
+async def transcribe_chunks(chunks: List[np.ndarray], language_code: str) -> List[str]:
+    """Queues a request's VAD chunks for the batcher and waits for their texts."""
+    if not chunks:
+        return []
+    future = asyncio.get_running_loop().create_future()
+    await transcription_queue.put((chunks, language_code, future))
+    return await future
+
+# --- Inference Jobs ---
+# Blocking GPU cores of the upload endpoints. They run on a worker thread, under
+# gpu_semaphore, so the event loop keeps serving other uploads while CUDA/pyannote
+# work. Audio is decoded beforehand, outside the semaphore.
+def prepare_transcription(audio, language: Optional[str] = None):
+    """
+    Finds speech with VAD. The language is detected only when the client did
+    not provide one.
+    """
+    pipeline = models['whisper']
+
+    with torch.inference_mode():
+        # Same VAD pass WhisperX's pipeline runs before transcribing
+        if isinstance(pipeline.vad_model, Vad):
+            waveform = pipeline.vad_model.preprocess_audio(audio)
+            merge_chunks = pipeline.vad_model.merge_chunks
+        else:
+            waveform = Pyannote.preprocess_audio(audio)
+            merge_chunks = Pyannote.merge_chunks
+
+        vad_segments = pipeline.vad_model({"waveform": waveform, "sample_rate": SAMPLE_RATE})
+        vad_segments = merge_chunks(
+            vad_segments,
+            VAD_CHUNK_SIZE,
+            onset=pipeline._vad_params["vad_onset"],
+            offset=pipeline._vad_params["vad_offset"],
+        )
+        language_code = language or pipeline.detect_language(audio)
+
+    return vad_segments, language_code
+
+def finish_transcription(audio, segments: List[Dict], language_code: str) -> ORJSONResponse:
+    """Aligns the decoded segments, assigns speakers and builds the SRT."""
+    with torch.inference_mode():
+        align_model, metadata = get_align_model(language_code)
+        result = whisperx.align(segments, align_model, metadata, audio, DEVICE, return_char_alignments=False)
+
+    if diarize_model := models.get('diarize'):
+        diarize_segments = diarize_model(audio)
+        result = whisperx.assign_word_speakers(diarize_segments, result)
+
+    # This part is updated
+    srt_output = generate_srt(result["segments"])
+
+    # Return both SRT and the raw segments
+    return ORJSONResponse({
+        "srt_content": srt_output,
+        "segments": result["segments"]
+    })
+
+async def transcribe_job(upload, language: Optional[str] = None) -> ORJSONResponse:
+    """
+    Runs a transcription in three steps after decoding the upload: VAD and
+    language detection, decoding through the shared batcher, then alignment and
+    diarization. Only the GPU steps hold the semaphore, so other requests' chunks
+    can join the batch.
+    """
+    audio = await anyio.to_thread.run_sync(load_audio_cached, upload)
+
+    async with gpu_semaphore:
+        vad_segments, language_code = await anyio.to_thread.run_sync(prepare_transcription, audio, language)
+
+    chunks = [audio[int(seg['start'] * SAMPLE_RATE):int(seg['end'] * SAMPLE_RATE)] for seg in vad_segments]
+    texts = await transcribe_chunks(chunks, language_code)
+    segments = [
+        {"text": text, "start": round(seg['start'], 3), "end": round(seg['end'], 3)}
+        for seg, text in zip(vad_segments, texts)
+    ]
+
+    async with gpu_semaphore:
+        return await anyio.to_thread.run_sync(finish_transcription, audio, segments, language_code)
+
+def run_resync(audio, transcript: str, language: Optional[str] = None) -> ORJSONResponse:
+    with torch.inference_mode():
+        # The transcript comes from the client, so Whisper is only needed to identify
+        # the language, and only from the first 30s window it reads anyway.
+        language_code = language or get_language_detector().detect_language(audio[:N_SAMPLES])
+
+        align_model, metadata = get_align_model(language_code)
+
+        transcript_segments = [{"text": line} for line in transcript.splitlines() if line.strip()]
+
+        result_aligned = whisperx.align(transcript_segments, align_model, metadata, audio, DEVICE, return_char_alignments=False)
+
+    srt_output = generate_srt(result_aligned["segments"])
+
+    # Return both SRT and the raw segments
+    return ORJSONResponse({
+        "srt_content": srt_output,
+        "segments": result_aligned["segments"]
+    })
+
+def run_refine_diarization(audio, user_segments: List[Dict]) -> ORJSONResponse:
+    diarize_model = models.get('diarize')
+    if not diarize_model:
+        raise HTTPException(status_code=500, detail="Diarization model not loaded.")
+
+    # 1. Re-run diarization to get a fresh, accurate segmentation from the AI
+    # The pipeline returns a DataFrame with one row per speaker turn (start, end, speaker);
+    # everything below works on it directly instead of a pyannote Annotation.
+    print("Running fresh diarization...")
+    diarize_df = diarize_model(audio)
+
+    # 2. Build a mapping from AI labels ('SPEAKER_01') to user names ('Alice')
+    # Flatten the turns into arrays once so each user segment is scored in a single vectorized pass.
+    turn_starts = diarize_df['start'].to_numpy()
+    turn_ends = diarize_df['end'].to_numpy()
+    turn_labels, label_ids = np.unique(diarize_df['speaker'].to_numpy(), return_inverse=True)
+
+    speaker_map = {}
+    print("Building speaker map from user edits...")
+    for segment in user_segments:
+        speaker_name = segment.get('speaker')
+        # We only care about segments where the user has assigned a meaningful name
+        if not speaker_name or speaker_name.startswith("SPEAKER_"):
+            continue
+
+        # Time each AI turn overlaps the user-edited segment, summed per AI speaker
+        overlap = np.clip(np.minimum(turn_ends, segment['end']) - np.maximum(turn_starts, segment['start']), 0, None)
+        speaker_durations = np.bincount(label_ids, weights=overlap, minlength=len(turn_labels))
+
+        if speaker_durations.any():
+            # Find the AI speaker label with the maximum duration in the overlap
+            dominant_ai_speaker = str(turn_labels[speaker_durations.argmax()])
+
+            # If we haven't mapped this AI speaker yet, add it to our map
+            if dominant_ai_speaker not in speaker_map:
+                 print(f"Mapping AI label {dominant_ai_speaker} to user name '{speaker_name}'")
+                 speaker_map[dominant_ai_speaker] = speaker_name
+
+    # 3. Rename the labels in the new diarization using the map
+    print(f"Applying new names: {speaker_map}")
+    # Turns whose AI label has no user name keep the original label.
+    diarize_df['speaker'] = diarize_df['speaker'].map(speaker_map).fillna(diarize_df['speaker'])
+
+    # 4. Re-assign word-level speakers using the refined diarization and user's text
+    result_no_speakers = {"segments": [{"text": s["text"], "start": s["start"], "end": s["end"]} for s in user_segments]}
+    result_refined = whisperx.assign_word_speakers(diarize_df, result_no_speakers)
+
+    srt_output = generate_srt(result_refined["segments"])
+
+    return ORJSONResponse({
+        "srt_content": srt_output,
+        "segments": result_refined["segments"]
+    })
 
 # --- API Endpoints ---
 @app.get("/")
@@ -107,44 +577,21 @@ def read_root():
     return {"message": "WhisperX Subtitle Generator API is running!"}
 
 @app.post("/transcribe")
-async def transcribe_audio(file: UploadFile = File(...)):
+async def transcribe_audio(file: UploadFile = File(...), language: Optional[str] = Form(None)):
     """
     Transcribes an audio/video file and returns both the raw segment data
-    and the formatted SRT content.
+    and the formatted SRT content. Passing `language` skips language detection.
     """
     if not file.content_type.startswith(('audio/', 'video/')): # type: ignore
         raise HTTPException(status_code=400, detail="Invalid file type.")
+    if language and language not in LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"Unsupported language '{language}'.")
 
-    with tempfile.NamedTemporaryFile(delete=True, suffix=os.path.splitext(file.filename)[1]) as temp_file: # type: ignore
-        content = await file.read()
-        temp_file.write(content)
-        temp_file.flush()
-
-        try:
-            audio = whisperx.load_audio(temp_file.name)
-            result = models['whisper'].transcribe(audio, batch_size=16)
-            
-            language_code = result["language"]
-            align_model, metadata = whisperx.load_align_model(language_code=language_code, device=DEVICE)
-            result = whisperx.align(result["segments"], align_model, metadata, audio, DEVICE, return_char_alignments=False)
-            del align_model
-            torch.cuda.empty_cache()
-
-            if diarize_model := models.get('diarize'):
-                diarize_segments = diarize_model(audio)
-                result = whisperx.assign_word_speakers(diarize_segments, result)
-            
-            # This part is updated
-            srt_output = generate_srt(result["segments"])
-            
-            # Return both SRT and the raw segments
-            return {
-                "srt_content": srt_output,
-                "segments": result["segments"]
-            }
-
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        return await transcribe_job(file.file, language)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/rename_speakers")
 async def rename_speakers(request: RenameSpeakersRequest):
@@ -152,63 +599,44 @@ async def rename_speakers(request: RenameSpeakersRequest):
     Takes segment data and a speaker map, returns the updated segments
     and a new SRT file with the names updated.
     """
-    updated_segments = []
-    for segment_model in request.segments:
-        segment = segment_model.model_dump()
-        if segment.get("speaker") in request.speaker_map:
-            new_name = request.speaker_map[segment["speaker"]]
-            if new_name:
-                segment["speaker"] = new_name
-        updated_segments.append(segment)
+    # Blank names leave the original label in place
+    speaker_map = {label: name for label, name in request.speaker_map.items() if name}
+
+    updated_segments = request.segments
+    for segment in updated_segments:
+        speaker = segment.get("speaker")
+        if speaker is None:
+            # A null speaker would print as "[None]"; treat it as no speaker at all
+            segment.pop("speaker", None)
+        elif speaker in speaker_map:
+            segment["speaker"] = speaker_map[speaker]
 
     new_srt = generate_srt(updated_segments)
     
-    return {
+    return ORJSONResponse({
         "srt_content": new_srt,
         "segments": updated_segments
-    }
+    })
 
 
 @app.post("/resync")
-async def resynchronize(file: UploadFile = File(...), transcript: str = Form(...)):
+async def resynchronize(file: UploadFile = File(...), transcript: str = Form(...), language: Optional[str] = Form(None)):
     """
     Forces alignment of a given transcript to an audio/video file.
     Returns both the newly timed segments and the SRT content.
     """
     if not file.content_type.startswith(('audio/', 'video/')): # type: ignore
         raise HTTPException(status_code=400, detail="Invalid file type.")
+    if language and language not in LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"Unsupported language '{language}'.")
 
-    with tempfile.NamedTemporaryFile(delete=True, suffix=os.path.splitext(file.filename)[1]) as temp_file: # type: ignore
-        content = await file.read()
-        temp_file.write(content)
-        temp_file.flush()
-
-        try:
-            audio = whisperx.load_audio(temp_file.name)
-            
-            tiny_model = models['whisper_tiny']
-            result = tiny_model.transcribe(audio, batch_size=16)
-            language_code = result["language"]
-
-            align_model, metadata = whisperx.load_align_model(language_code=language_code, device=DEVICE)
-            
-            transcript_segments = [{"text": line} for line in transcript.splitlines() if line.strip()]
-            
-            result_aligned = whisperx.align(transcript_segments, align_model, metadata, audio, DEVICE, return_char_alignments=False)
-            
-            del align_model
-            torch.cuda.empty_cache()
-
-            srt_output = generate_srt(result_aligned["segments"])
-            
-            # Return both SRT and the raw segments
-            return {
-                "srt_content": srt_output,
-                "segments": result_aligned["segments"]
-            }
-        
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        audio = await anyio.to_thread.run_sync(load_audio_cached, file.file)
+        async with gpu_semaphore:
+            return await anyio.to_thread.run_sync(run_resync, audio, transcript, language)
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
         
 @app.post("/refine_diarization")
 async def refine_diarization(file: UploadFile = File(...), segments_json: str = Form(...)):
@@ -224,65 +652,12 @@ async def refine_diarization(file: UploadFile = File(...), segments_json: str =
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid segments_json format.")
 
-    with tempfile.NamedTemporaryFile(delete=True, suffix=os.path.splitext(file.filename)[1]) as temp_file: # type: ignore
-        content = await file.read()
-        temp_file.write(content)
-        temp_file.flush()
-
-        try:
-            audio = whisperx.load_audio(temp_file.name)
-            diarize_model = models.get('diarize')
-            if not diarize_model:
-                raise HTTPException(status_code=500, detail="Diarization model not loaded.")
-
-            # 1. Re-run diarization to get a fresh, accurate segmentation from the AI
-            print("Running fresh diarization...")
-            new_diarize_segments = diarize_model(audio)
-
-            # 2. Build a mapping from AI labels ('SPEAKER_01') to user names ('Alice')
-            speaker_map = {}
-            print("Building speaker map from user edits...")
-            for segment in user_segments:
-                speaker_name = segment.get('speaker')
-                # We only care about segments where the user has assigned a meaningful name
-                if not speaker_name or speaker_name.startswith("SPEAKER_"):
-                    continue
-
-                segment_span = PyannoteSegment(segment['start'], segment['end'])
-                
-                # Find which AI speaker dominates the user-edited segment's timeframe
-                overlapping_speakers = new_diarize_segments.crop(segment_span)
-                
-                if overlapping_speakers:
-                    # Get total duration for each speaker within this cropped segment
-                    speaker_durations = {label: overlapping_speakers.label_duration(label) for label in overlapping_speakers.labels()}
-                    if speaker_durations:
-                        # Find the AI speaker label with the maximum duration in the overlap
-                        dominant_ai_speaker = max(speaker_durations, key=speaker_durations.get) # type: ignore
-                        
-                        # If we haven't mapped this AI speaker yet, add it to our map
-                        if dominant_ai_speaker not in speaker_map:
-                             print(f"Mapping AI label {dominant_ai_speaker} to user name '{speaker_name}'")
-                             speaker_map[dominant_ai_speaker] = speaker_name
-
-            # 3. Rename the labels in the new diarization using the map
-            print(f"Applying new names: {speaker_map}")
-            # The .rename_labels() method creates a new Annotation object.
-            # We use .get as a generator to keep original labels if they're not in the map.
-            final_diarization = new_diarize_segments.rename_labels(generator=speaker_map.get)
-            
-            # 4. Re-assign word-level speakers using the refined diarization and user's text
-            result_no_speakers = {"segments": [{"text": s["text"], "start": s["start"], "end": s["end"]} for s in user_segments]}
-            result_refined = whisperx.assign_word_speakers(final_diarization, result_no_speakers)
-
-            srt_output = generate_srt(result_refined["segments"])
-            
-            return {
-                "srt_content": srt_output,
-                "segments": result_refined["segments"]
-            }
-
-        except Exception as e:
-            import traceback
-            print(traceback.format_exc()) # Log the full error for easier debugging
-            raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+    try:
+        audio = await anyio.to_thread.run_sync(load_audio_cached, file.file)
+        async with gpu_semaphore:
+            return await anyio.to_thread.run_sync(run_refine_diarization, audio, user_segments)
+
+    except Exception as e:
+        import traceback
+        print(traceback.format_exc()) # Log the full error for easier debugging
+        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Make main.py importable when pytest is run from subtitlerBackend/ or the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+import io
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+import main
+
+MIB_OF_SAMPLES = (1 << 20) // np.dtype(np.float32).itemsize
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """Replaces the decoder with one that returns `<n> MiB` of PCM for an upload reading b"<name>:<n>"."""
+    calls = []
+
+    def decode_upload(upload):
+        name, mib = upload.getvalue().decode().split(":")
+        calls.append(name)
+        return np.zeros(int(mib) * MIB_OF_SAMPLES, dtype=np.float32)
+
+    monkeypatch.setattr(main, "decode_upload", decode_upload)
+    monkeypatch.setattr(main, "audio_cache", OrderedDict())
+    monkeypatch.setattr(main, "AUDIO_CACHE_MB", 2)
+    return calls
+
+
+def load(content):
+    return main.load_audio_cached(io.BytesIO(content.encode()))
+
+
+def test_repeat_upload_is_served_from_cache(decodes):
+    first = load("a:1")
+    again = load("a:1")
+
+    assert again is first
+    assert decodes == ["a"]
+
+
+def test_least_recently_used_decode_is_evicted_past_the_byte_budget(decodes):
+    load("a:1")
+    load("b:1")
+    load("a:1")  # a is now more recently used than b
+    load("c:1")  # 3 MiB > 2 MiB budget: b goes
+
+    assert len(main.audio_cache) == 2
+    load("a:1")
+    load("c:1")
+    load("b:1")
+    assert decodes == ["a", "b", "c", "b"]
+
+
+def test_decode_larger_than_the_budget_is_returned_but_not_cached(decodes):
+    load("a:1")
+    audio = load("huge:3")
+
+    assert audio.nbytes == 3 << 20
+    assert [cached.nbytes for cached in main.audio_cache.values()] == [1 << 20]
+    load("a:1")
+    assert decodes == ["a", "huge"]
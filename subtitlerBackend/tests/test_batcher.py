@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def fake_decode_jobs(calls):
+    """Stands in for the Whisper decode: records each batch and echoes '<lang>:<chunk>' per chunk."""
+    def decode_jobs(jobs):
+        calls.append([(list(chunks), language_code) for chunks, language_code, _ in jobs])
+        return [[f"{language_code}:{chunk}" for chunk in chunks] for chunks, language_code, _ in jobs]
+    return decode_jobs
+
+
+async def run_jobs(*jobs):
+    """Queues every job before the batcher starts, then lets it resolve them."""
+    tasks = [asyncio.create_task(main.transcribe_chunks(chunks, language_code)) for chunks, language_code in jobs]
+    # One loop iteration runs each task up to its `await future`, so all jobs are queued
+    await asyncio.sleep(0)
+    assert main.transcription_queue.qsize() == len(jobs)
+
+    worker = asyncio.create_task(main.batch_worker())
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        worker.cancel()
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "decode_jobs", fake_decode_jobs(calls))
+
+    def run(*jobs):
+        async def scenario():
+            # Fresh primitives bound to this test's event loop
+            monkeypatch.setattr(main, "transcription_queue", asyncio.Queue())
+            monkeypatch.setattr(main, "gpu_semaphore", asyncio.Semaphore(1))
+            return await run_jobs(*jobs)
+        return asyncio.run(scenario())
+
+    return run, calls
+
+
+def test_queued_jobs_share_one_batch_and_get_their_own_texts(batcher, monkeypatch):
+    run, calls = batcher
+    monkeypatch.setattr(main, "BATCH_SIZE", 16)
+
+    results = run((["a1", "a2"], "en"), (["b1"], "es"))
+
+    assert results == [["en:a1", "en:a2"], ["es:b1"]]
+    assert calls == [[(["a1", "a2"], "en"), (["b1"], "es")]]
+
+
+def test_batch_stops_draining_at_batch_size(batcher, monkeypatch):
+    run, calls = batcher
+    monkeypatch.setattr(main, "BATCH_SIZE", 2)
+
+    results = run((["a1", "a2"], "en"), (["b1"], "en"))
+
+    assert results == [["en:a1", "en:a2"], ["en:b1"]]
+    assert calls == [[(["a1", "a2"], "en")], [(["b1"], "en")]]
+
+
+def test_decode_failure_is_raised_in_every_job_of_the_batch(monkeypatch):
+    def failing_decode_jobs(jobs):
+        raise RuntimeError("CUDA out of memory")
+    monkeypatch.setattr(main, "decode_jobs", failing_decode_jobs)
+    monkeypatch.setattr(main, "BATCH_SIZE", 16)
+
+    async def scenario():
+        monkeypatch.setattr(main, "transcription_queue", asyncio.Queue())
+        monkeypatch.setattr(main, "gpu_semaphore", asyncio.Semaphore(1))
+        return await run_jobs((["a1"], "en"), (["b1"], "en"))
+
+    results = asyncio.run(scenario())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,55 @@
+import orjson
+import pandas as pd
+import pytest
+
+import main
+
+
+@pytest.fixture
+def diarization(monkeypatch):
+    """Installs a fake diarization model returning the given turns; yields a setter for them."""
+    turns = {}
+
+    def set_turns(rows):
+        turns["df"] = pd.DataFrame(rows, columns=["start", "end", "speaker"])
+        return turns["df"]
+
+    monkeypatch.setitem(main.models, "diarize", lambda audio: turns["df"])
+    return set_turns
+
+
+def user_segment(start, end, speaker):
+    return {"start": start, "end": end, "text": f"{start}-{end}", "speaker": speaker}
+
+
+def test_each_ai_speaker_takes_the_name_that_dominates_its_turns(diarization):
+    diarize_df = diarization([
+        (0, 4, "SPEAKER_00"),
+        (4, 10, "SPEAKER_01"),
+        (10, 12, "SPEAKER_00"),
+        (12, 14, "SPEAKER_02"),
+    ])
+
+    response = main.run_refine_diarization(None, [
+        user_segment(0, 5, "Alice"),        # 4s of SPEAKER_00 against 1s of SPEAKER_01
+        user_segment(5, 10, "Bob"),
+        user_segment(10, 12, "Carol"),      # SPEAKER_00 is already Alice: the first name wins
+        user_segment(12, 14, "SPEAKER_02"), # generic labels are not names
+        user_segment(20, 21, "Eve"),        # overlaps no turn
+    ])
+
+    assert diarize_df["speaker"].tolist() == ["Alice", "Bob", "Alice", "SPEAKER_02"]
+    speakers = [segment.get("speaker") for segment in orjson.loads(response.body)["segments"]]
+    assert speakers[:4] == ["Alice", "Bob", "Alice", "SPEAKER_02"]
+
+
+def test_tied_overlap_goes_to_the_lowest_label(diarization):
+    # Same tie-break as pyannote's sorted Annotation.labels(), not the earliest turn
+    diarize_df = diarization([
+        (0, 1, "SPEAKER_01"),
+        (1, 2, "SPEAKER_00"),
+    ])
+
+    main.run_refine_diarization(None, [user_segment(0, 2, "Dana")])
+
+    assert diarize_df["speaker"].tolist() == ["SPEAKER_01", "Dana"]
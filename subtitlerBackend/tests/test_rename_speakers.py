@@ -0,0 +1,61 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+# No `with` block: startup handlers (model loading) don't run for this CPU-only endpoint
+client = TestClient(main.app)
+
+
+def segment(**overrides):
+    return {"start": 0.0, "end": 1.5, "text": " Hello there. ", "speaker": "SPEAKER_00", **overrides}
+
+
+def test_renames_mapped_speakers_and_keeps_extra_keys():
+    words = [{"word": "Hello", "start": 0.0, "end": 0.4, "score": 0.9, "speaker": "SPEAKER_00"}]
+    response = client.post("/rename_speakers", json={
+        "segments": [
+            segment(words=words),
+            segment(start=2, end=3, text="Hi.", speaker="SPEAKER_01"),
+        ],
+        # Blank names leave the original label in place
+        "speaker_map": {"SPEAKER_00": "Alice", "SPEAKER_01": ""},
+    })
+
+    assert response.status_code == 200
+    body = response.json()
+    assert [seg["speaker"] for seg in body["segments"]] == ["Alice", "SPEAKER_01"]
+    assert body["segments"][0]["words"] == words
+    assert body["srt_content"] == (
+        "1\n00:00:00,000 --> 00:00:01,500\n[Alice]: Hello there.\n\n"
+        "2\n00:00:02,000 --> 00:00:03,000\n[SPEAKER_01]: Hi.\n\n"
+    )
+
+
+def test_null_speaker_is_treated_as_absent():
+    response = client.post("/rename_speakers", json={
+        "segments": [segment(speaker=None)],
+        "speaker_map": {},
+    })
+
+    assert response.status_code == 200
+    body = response.json()
+    assert "speaker" not in body["segments"][0]
+    assert body["srt_content"] == "1\n00:00:00,000 --> 00:00:01,500\nHello there.\n\n"
+
+
+@pytest.mark.parametrize("bad_segment, field", [
+    ({"end": 1.5, "text": "Hi."}, "start"),
+    (segment(end=True), "end"),
+    (segment(text=None), "text"),
+    (segment(speaker=["SPEAKER_00"]), "speaker"),
+])
+def test_malformed_segment_is_a_standard_422(bad_segment, field):
+    response = client.post("/rename_speakers", json={
+        "segments": [segment(), bad_segment],
+        "speaker_map": {},
+    })
+
+    assert response.status_code == 422
+    errors = response.json()["detail"]
+    assert [error["loc"] for error in errors] == [["body", "segments", 1, field]]
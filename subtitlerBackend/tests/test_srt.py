@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("seconds, expected", [
+    (0, "00:00:00,000"),
+    (1.001, "00:00:01,001"),
+    (59.9999, "00:00:59,999"),
+    (3661, "01:01:01,000"),
+    (86399.999, "23:59:59,999"),
+    (86400, "24:00:00,000"),
+    (90061.5, "25:01:01,500"),
+])
+def test_format_time(seconds, expected):
+    assert main.format_time(seconds) == expected
+
+
+def test_format_time_keeps_every_millisecond_timestamp():
+    # WhisperX rounds times to 3 decimals; none of them may lose a millisecond to float error
+    rng = random.Random(0)
+    for milliseconds in [rng.randrange(0, 10 * 3_600_000) for _ in range(200_000)]:
+        hours, rest = divmod(milliseconds, 3_600_000)
+        minutes, rest = divmod(rest, 60_000)
+        seconds, rest = divmod(rest, 1000)
+        assert main.format_time(milliseconds / 1000) == f"{hours:02}:{minutes:02}:{seconds:02},{rest:03}"
+
+
+def test_generate_srt_labels_only_cues_with_a_speaker():
+    segments = [
+        {"start": 0.0, "end": 1.0, "text": " Hi. ", "speaker": "SPEAKER_00"},
+        {"start": 1.0, "end": 2.5, "text": "Anyone there?"},
+    ]
+
+    assert main.generate_srt(segments) == (
+        "1\n00:00:00,000 --> 00:00:01,000\n[SPEAKER_00]: Hi.\n\n"
+        "2\n00:00:01,000 --> 00:00:02,500\nAnyone there?\n\n"
+    )